@@ -1,15 +1,24 @@
 """
 Support session caching.
 
-Sessions for assumed roles will persist for up to an hour; we can avoid
-calling assume role multiple times if we reuse the same session.
+Sessions for assumed roles will persist for up to an hour (or up to the role's
+maximum session duration); we can avoid calling assume role multiple times if we
+reuse the same session.
 """
-from os import environ
+from errno import EEXIST
+from json import dump, load
+from os import environ, makedirs
+from os.path import dirname, expanduser
 from time import time
 from uuid import UUID, uuid1
 
 
 DEFAULT_SESSION_DURATION = 3600
+MAX_SESSION_DURATION = 43200
+
+# durations (longest first) to search when a role's maximum is not known;
+# the negotiated maximum is rounded down to a whole hour
+SESSION_DURATIONS = range(MAX_SESSION_DURATION, DEFAULT_SESSION_DURATION - 1, -3600)
 
 
 def uuid1_to_timestamp(uuid):
@@ -26,10 +35,11 @@ def uuid1_to_timestamp(uuid):
 
 class CachedSession(object):
 
-    def __init__(self, name, token, profile):
+    def __init__(self, name, token, profile, duration=None):
         self.name = name
         self.token = token
         self.profile = profile
+        self.duration = duration
 
     @classmethod
     def make_name(cls):
@@ -46,7 +56,9 @@ class CachedSession(object):
         """
         Load a session from environment variables.
 
-        Introduces the `AWS_SESSION_NAME` variable to save the session's name.
+        Introduces the `AWS_SESSION_NAME` variable to save the session's name and
+        the `AWS_SESSION_DURATION` variable to save the duration it was issued with;
+        the latter takes precedence over `session_duration` if set (and valid).
         """
         envvars = ["AWS_SESSION_NAME", "AWS_SESSION_TOKEN", "AWS_PROFILE"]
         variables = [environ.get(key) for key in envvars]
@@ -58,8 +70,11 @@ class CachedSession(object):
         if now is None:
             now = time()
 
-        if session_duration is None:
-            session_duration = DEFAULT_SESSION_DURATION
+        try:
+            session_duration = int(environ["AWS_SESSION_DURATION"])
+        except (KeyError, ValueError):
+            if session_duration is None:
+                session_duration = DEFAULT_SESSION_DURATION
 
         session_timestamp = uuid1_to_timestamp(name)
         if (session_timestamp + session_duration) < now:
@@ -69,4 +84,55 @@ class CachedSession(object):
             name=name,
             token=token,
             profile=profile,
+            duration=session_duration,
         )
+
+
+def get_session_durations_path():
+    """
+    Get the path of the session duration cache from the environment.
+    """
+    return environ.get(
+        "AWSENV_SESSION_DURATIONS_FILE",
+        expanduser("~/.aws/awsenv_session_durations.json"),
+    )
+
+
+class CachedSessionDurations(object):
+    """
+    On-disk cache of each role's maximum session duration.
+
+    Saves negotiating the duration with STS every time a role is assumed.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_session_durations_path()
+
+    def load(self):
+        try:
+            with open(self.path) as file_:
+                return load(file_)
+        except (IOError, ValueError):
+            return {}
+
+    def get(self, role_arn):
+        return self.load().get(role_arn)
+
+    def set(self, role_arn, session_duration):
+        """
+        Save a role's session duration.
+
+        Saving is best-effort: failing to write the cache must not lose a session.
+        """
+        durations = self.load()
+        durations[role_arn] = session_duration
+        try:
+            if dirname(self.path):
+                try:
+                    makedirs(dirname(self.path))
+                except OSError as error:
+                    if error.errno != EEXIST:
+                        raise
+            with open(self.path, "w") as file_:
+                dump(durations, file_)
+        except (IOError, OSError):
+            pass
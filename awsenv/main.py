@@ -38,6 +38,10 @@ def parse_args(args):
         "--refresh",
         action="store_true",
     )
+    parser.add_argument(
+        "--max-session-duration",
+        action="store_true",
+    )
     args = parser.parse_args(args)
     return args
 
@@ -57,16 +61,23 @@ def get_profile(profile=None,
                 session_duration=DEFAULT_SESSION_DURATION,
                 assume_role=True,
                 refresh=False,
-                account_id=None):
+                account_id=None,
+                session_factory=None,
+                max_session_duration=False):
     """
     Construct an AWS Profile.
 
     :param profile: the name of the profile to use; resolves via environment
            variables if not set
     :param session_duration: the session duration (in seconds), defafults to
-           one hour, which is also the maximum
+           one hour
     :param assume_role: control whether the given profile's role will be assumed;
            if not, the default profile's credentials will be used
+    :param session_factory: a `SessionFactory` to share configuration and clients
+           between profiles, if any
+    :param max_session_duration: request the longest session duration each role permits,
+           as configured by `duration_seconds` or discovered from STS and cached on disk;
+           refreshing discovers it again
     """
     # choose the profile name if necessary
     if profile is None:
@@ -83,6 +94,9 @@ def get_profile(profile=None,
         session_duration=session_duration,
         cached_session=cached_session,
         account_id=account_id,
+        session_factory=session_factory,
+        max_session_duration=max_session_duration,
+        refresh=refresh,
     )
     if assume_role:
         aws_profile.update_credentials()
@@ -96,5 +110,6 @@ def main():
         profile=args.profile,
         session_duration=args.session_duration,
         refresh=args.refresh,
+        max_session_duration=args.max_session_duration,
     )
     print to_environment(profile.to_envvars())  # noqa
@@ -1,12 +1,19 @@
 """
 Profile-aware session wrapper.
 """
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from os import environ
 
-from botocore.exceptions import ProfileNotFound
+from botocore.exceptions import (
+    BotoCoreError,
+    ClientError,
+    ParamValidationError,
+    ProfileNotFound,
+)
 from botocore.session import Session
 
-from awsenv.cache import CachedSession
+from awsenv.cache import CachedSession, CachedSessionDurations, SESSION_DURATIONS
 
 
 def get_default_profile_name():
@@ -16,13 +23,115 @@ def get_default_profile_name():
     return environ.get("AWS_DEFAULT_PROFILE", "default")
 
 
+def fan_out_clients(clients, operation_name, max_workers=None, **kwargs):
+    """
+    Invoke the same operation concurrently for several regional clients.
+
+    Calls run on a thread pool (one thread per client by default); yields
+    `(region_name, result, error)` triples as the calls complete. A call that fails
+    with an AWS error does not interrupt the others: its triple has a `None` result
+    and the error instead. Unknown operations and invalid parameters are raised.
+
+    :param clients: a dictionary from region name to client, as returned by
+           `create_regional_clients`
+    :param operation_name: the name of the client method to invoke
+    :param max_workers: the maximum number of concurrent calls
+    """
+    # resolve operations up front so that unknown operations are raised immediately
+    operations = [
+        (region_name, getattr(client, operation_name))
+        for region_name, client in clients.items()
+    ]
+
+    def invoke(item):
+        region_name, operation = item
+        try:
+            return region_name, operation(**kwargs), None
+        except ParamValidationError:
+            raise
+        except (BotoCoreError, ClientError) as error:
+            return region_name, None, error
+
+    if not operations:
+        return
+
+    pool = ThreadPool(max_workers or len(operations))
+    try:
+        for result in pool.imap_unordered(invoke, operations):
+            yield result
+    finally:
+        pool.terminate()
+
+
+def is_session_duration_error(error):
+    """
+    Is a client error a rejection of the requested session duration?
+    """
+    details = error.response.get("Error", {})
+    return (
+        details.get("Code") == "ValidationError" and
+        "DurationSeconds" in details.get("Message", "")
+    )
+
+
+class SessionFactory(object):
+    """
+    Create botocore sessions that share configuration and loaders.
+
+    Each botocore session otherwise parses the configuration files and builds its
+    own data loader; sessions created by the same factory reuse those of a single
+    base session. Clients created through the factory are
+    also shared, so that profiles with the same source profile reuse one STS client.
+    """
+    SHARED_COMPONENTS = ["data_loader"]
+
+    def __init__(self):
+        self.base_session = Session()
+        self.clients = {}
+
+    def create_session(self, profile=None):
+        """
+        Create a session for a profile.
+        """
+        session = Session(profile=profile)
+        # copy the profiles so that generated profile configuration stays per-session
+        full_config = self.base_session.full_config
+        session._config = dict(full_config, profiles=dict(full_config["profiles"]))
+        for name in self.SHARED_COMPONENTS:
+            session.register_component(name, self.base_session.get_component(name))
+        return session
+
+    def create_client(self,
+                      session,
+                      service_name,
+                      region_name,
+                      aws_access_key_id,
+                      aws_secret_access_key):
+        """
+        Create (or reuse) a client for the given region and credentials.
+        """
+        key = (service_name, region_name, aws_access_key_id, aws_secret_access_key)
+        if key not in self.clients:
+            self.clients[key] = session.create_client(
+                service_name=service_name,
+                region_name=region_name,
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+            )
+        return self.clients[key]
+
+
 class AWSSession(object):
     """
     AWS session wrapper.
     """
-    def __init__(self, profile=None):
+    def __init__(self, profile=None, session_factory=None):
         self.profile = profile
-        self.session = Session(profile=self.profile)
+        self.session_factory = session_factory
+        if self.session_factory is None:
+            self.session = Session(profile=self.profile)
+        else:
+            self.session = self.session_factory.create_session(self.profile)
 
     @property
     def access_key_id(self):
@@ -53,18 +162,58 @@ class AWSSession(object):
         Automatically populates the region name, access key, secret key, and session token.
         Allows other parameters to be passed.
         """
-        return self.session.create_client(
+        return self.create_regional_clients(
             service_name=service_name,
-            region_name=self.region_name,
-            aws_access_key_id=self.access_key_id,
-            aws_secret_access_key=self.secret_access_key,
-            aws_session_token=self.session_token,
+            region_names=[self.region_name],
             api_version=api_version,
             use_ssl=use_ssl,
             verify=verify,
             endpoint_url=endpoint_url,
             config=config,
+        )[self.region_name]
+
+    def create_regional_clients(self,
+                                service_name,
+                                region_names,
+                                api_version=None,
+                                use_ssl=True,
+                                verify=None,
+                                endpoint_url=None,
+                                config=None):
+        """
+        Create a service client for each of several regions from the wrapped session.
+
+        The access key, secret key, and session token are resolved once and shared by
+        all clients. Returns a dictionary from region name to client.
+        """
+        credentials = dict(
+            aws_access_key_id=self.access_key_id,
+            aws_secret_access_key=self.secret_access_key,
+            aws_session_token=self.session_token,
         )
+        return {
+            region_name: self.session.create_client(
+                service_name=service_name,
+                region_name=region_name,
+                api_version=api_version,
+                use_ssl=use_ssl,
+                verify=verify,
+                endpoint_url=endpoint_url,
+                config=config,
+                **credentials
+            )
+            for region_name in region_names
+        }
+
+    def fan_out(self, service_name, region_names, operation_name, max_workers=None, **kwargs):
+        """
+        Invoke the same operation concurrently in several regions.
+
+        Creates a client per region (see `create_regional_clients`) and invokes the
+        operation with each (see `fan_out_clients`).
+        """
+        clients = self.create_regional_clients(service_name, region_names)
+        return fan_out_clients(clients, operation_name, max_workers, **kwargs)
 
 
 class AWSProfile(AWSSession):
@@ -75,20 +224,30 @@ class AWSProfile(AWSSession):
                  profile,
                  session_duration,
                  cached_session,
-                 account_id=None):
+                 account_id=None,
+                 session_factory=None,
+                 max_session_duration=False,
+                 refresh=False):
         """
         Configure a session for a profile.
 
         :param profile: the name of the profile to use, if any
         :param session_duration: the duration of the session (in seconds)
-               must be in the range 900-3600
+               must be in the range 900-43200 and within the role's maximum
         :param cached_session: the cached session to use, if any
         :param account_id: the account id for profile auto-generation (if any)
+        :param session_factory: the session factory to share configuration with, if any
+        :param max_session_duration: request the longest session duration the role permits
+               instead of `session_duration`
+        :param refresh: ignore any cached maximum session duration and negotiate it again
         """
         self.session_duration = session_duration
         self.cached_session = cached_session
         self.account_id = account_id
-        super(AWSProfile, self).__init__(profile)
+        self.max_session_duration = max_session_duration
+        self.refresh = refresh
+        self.cached_session_durations = CachedSessionDurations()
+        super(AWSProfile, self).__init__(profile, session_factory)
 
     @property
     def access_key_id(self):
@@ -106,6 +265,14 @@ class AWSProfile(AWSSession):
     def role_arn(self):
         return self.profile_config.get("role_arn")
 
+    @property
+    def configured_session_duration(self):
+        try:
+            return int(self.profile_config["duration_seconds"])
+        except (KeyError, ValueError):
+            # ignore missing or invalid configuration
+            return None
+
     @property
     def session_token(self):
         return self.cached_session.token if self.cached_session else None
@@ -114,6 +281,12 @@ class AWSProfile(AWSSession):
     def session_name(self):
         return self.cached_session.name if self.cached_session else None
 
+    @property
+    def session_duration_value(self):
+        if self.cached_session is None or self.cached_session.duration is None:
+            return None
+        return str(self.cached_session.duration)
+
     @property
     def profile_config(self):
         """
@@ -170,6 +343,7 @@ class AWSProfile(AWSSession):
             "AWS_DEFAULT_REGION": self.region_name,
             "AWS_PROFILE": self.profile,
             "AWS_SECRET_ACCESS_KEY": self.secret_access_key,
+            "AWS_SESSION_DURATION": self.session_duration_value,
             "AWS_SESSION_NAME": self.session_name,
             "AWS_SESSION_TOKEN": self.session_token,
         }
@@ -204,13 +378,77 @@ class AWSProfile(AWSSession):
             environ.get("AWS_SECRET_ACCESS_KEY", self.secret_access_key),
         )
 
+    def known_session_duration(self):
+        """
+        Return the role's maximum session duration, if configured or previously discovered.
+
+        The `duration_seconds` profile configuration takes precedence over the on-disk cache,
+        which is ignored when refreshing.
+        """
+        if not self.role_arn:
+            return None
+        if self.configured_session_duration or self.refresh:
+            return self.configured_session_duration
+        return self.cached_session_durations.get(self.role_arn)
+
+    def session_duration_candidates(self):
+        """
+        Return the session durations to request (longest first) when assuming the role.
+
+        Without a known maximum, durations are whole hours, so a negotiated maximum is
+        rounded down to a whole hour.
+        """
+        known_session_duration = self.known_session_duration()
+        if known_session_duration is None:
+            return SESSION_DURATIONS
+        return [known_session_duration] + [
+            session_duration
+            for session_duration in SESSION_DURATIONS
+            if session_duration < known_session_duration
+        ]
+
+    def negotiate_session_duration(self, assume_role):
+        """
+        Assume the role for the longest session duration it permits.
+
+        Tries the longest candidate first, then searches the remaining candidates;
+        STS rejects durations beyond the role's maximum, after which all shorter
+        durations are expected to succeed.
+
+        :param assume_role: a function that assumes the role for a given duration
+        :returns: the session duration and the result of assuming the role
+        """
+        session_durations = self.session_duration_candidates()
+        best, last_error = None, None
+        low, high = 0, len(session_durations) - 1
+        # try the longest duration first, then bisect
+        index = 0
+        while low <= high:
+            try:
+                best = session_durations[index], assume_role(session_durations[index])
+                high = index - 1
+            except ClientError as error:
+                if not is_session_duration_error(error):
+                    raise
+                last_error = error
+                low = index + 1
+            index = (low + high) // 2
+
+        if best is None:
+            raise last_error
+        return best
+
     def assume_role(self):
         """
         Assume a role.
         """
         # we need to pass in the regions and keys because botocore does not
         # automatically merge configuration from the source_profile
-        sts_client = self.session.create_client(
+        create_client = self.session.create_client
+        if self.session_factory is not None:
+            create_client = partial(self.session_factory.create_client, self.session)
+
+        sts_client = create_client(
             service_name="sts",
             region_name=self.region_name,
             aws_access_key_id=self.access_key_id,
@@ -218,17 +456,29 @@ class AWSProfile(AWSSession):
         )
 
         session_name = CachedSession.make_name()
-        result = sts_client.assume_role(**{
-            "RoleArn": self.role_arn,
-            "RoleSessionName": session_name,
-            "DurationSeconds": self.session_duration,
-        })
+
+        def assume_role(session_duration):
+            return sts_client.assume_role(**{
+                "RoleArn": self.role_arn,
+                "RoleSessionName": session_name,
+                "DurationSeconds": session_duration,
+            })
+
+        if self.max_session_duration:
+            session_duration, result = self.negotiate_session_duration(assume_role)
+            if self.configured_session_duration is None:
+                if self.cached_session_durations.get(self.role_arn) != session_duration:
+                    self.cached_session_durations.set(self.role_arn, session_duration)
+            self.session_duration = session_duration
+        else:
+            result = assume_role(self.session_duration)
 
         # update the cached session
         self.cached_session = CachedSession(
             name=session_name,
             token=result["Credentials"]["SessionToken"],
             profile=self.profile,
+            duration=self.session_duration,
         )
         return (
             result["Credentials"]["AccessKeyId"],
@@ -3,6 +3,12 @@ Helpers for tests.
 """
 from contextlib import contextmanager
 from os import environ
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp, NamedTemporaryFile
+from textwrap import dedent
+
+from awsenv.cache import CachedSessionDurations
 
 
 @contextmanager
@@ -14,3 +20,44 @@ def envvars(**kwargs):
         # not trying to restore existing values
         for key in kwargs:
             del environ[key]
+
+
+@contextmanager
+def custom_config(profile, role_arn=None, duration_seconds=None):
+    """
+    Inject a temporary AWS configuration, overriding ~/.aws/config.
+    """
+    with NamedTemporaryFile() as file_:
+        file_.write(dedent("""\
+            [default]
+            region = us-west-2
+
+            [profile {}]
+            {}
+            {}
+            source_profile = default
+        """.format(
+            profile,
+            "role_arn = {}".format(role_arn) if role_arn else "",
+            "duration_seconds = {}".format(duration_seconds) if duration_seconds else "",
+        )))
+        file_.flush()
+        environ["AWS_CONFIG_FILE"] = file_.name
+        try:
+            yield
+        finally:
+            del environ["AWS_CONFIG_FILE"]
+
+
+@contextmanager
+def custom_session_durations():
+    """
+    Inject a temporary session duration cache.
+    """
+    directory = mkdtemp()
+    environ["AWSENV_SESSION_DURATIONS_FILE"] = join(directory, "durations.json")
+    try:
+        yield CachedSessionDurations()
+    finally:
+        del environ["AWSENV_SESSION_DURATIONS_FILE"]
+        rmtree(directory)
@@ -1,11 +1,15 @@
 """
 Tests for cached session loading.
 """
+from os import chdir, getcwd
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
 from time import time
 
 from hamcrest import assert_that, is_, equal_to, none
 
-from awsenv.cache import CachedSession, DEFAULT_SESSION_DURATION
+from awsenv.cache import CachedSession, CachedSessionDurations, DEFAULT_SESSION_DURATION
 from awsenv.tests import envvars
 
 
@@ -38,3 +42,70 @@ def test_cached_session_valid():
         cached_session = CachedSession.from_environment(now=now)
         assert_that(cached_session.name, is_(equal_to(name)))
         assert_that(cached_session.token, is_(equal_to(token)))
+
+
+def test_cached_session_recorded_duration():
+    now = time() + 2 * DEFAULT_SESSION_DURATION
+    name, token, profile = CachedSession.make_name(), "token", "profile"
+    with envvars(AWS_SESSION_TOKEN=token, AWS_SESSION_NAME=name, AWS_PROFILE=profile):
+        # the recorded duration takes precedence over the requested duration
+        with envvars(AWS_SESSION_DURATION=str(DEFAULT_SESSION_DURATION)):
+            cached_session = CachedSession.from_environment(
+                now=now,
+                session_duration=4 * DEFAULT_SESSION_DURATION,
+            )
+            assert_that(cached_session, is_(none()))
+
+        with envvars(AWS_SESSION_DURATION=str(4 * DEFAULT_SESSION_DURATION)):
+            cached_session = CachedSession.from_environment(now=now)
+            assert_that(cached_session.duration, is_(equal_to(4 * DEFAULT_SESSION_DURATION)))
+
+
+def test_cached_session_invalid_recorded_duration():
+    now = time() + 2 * DEFAULT_SESSION_DURATION
+    name, token, profile = CachedSession.make_name(), "token", "profile"
+    with envvars(AWS_SESSION_TOKEN=token, AWS_SESSION_NAME=name, AWS_PROFILE=profile):
+        with envvars(AWS_SESSION_DURATION="12h"):
+            cached_session = CachedSession.from_environment(
+                now=now,
+                session_duration=4 * DEFAULT_SESSION_DURATION,
+            )
+            assert_that(cached_session.duration, is_(equal_to(4 * DEFAULT_SESSION_DURATION)))
+
+
+def test_cached_session_durations():
+    directory = mkdtemp()
+    try:
+        path = join(directory, "aws", "durations.json")
+        with envvars(AWSENV_SESSION_DURATIONS_FILE=path):
+            assert_that(CachedSessionDurations().get("role_arn"), is_(none()))
+            CachedSessionDurations().set("role_arn", 43200)
+            assert_that(CachedSessionDurations().get("role_arn"), is_(equal_to(43200)))
+            assert_that(CachedSessionDurations().get("other_role_arn"), is_(none()))
+    finally:
+        rmtree(directory)
+
+
+def test_cached_session_durations_relative_path():
+    directory, cwd = mkdtemp(), getcwd()
+    try:
+        chdir(directory)
+        cached_session_durations = CachedSessionDurations(path="durations.json")
+        cached_session_durations.set("role_arn", 43200)
+        assert_that(cached_session_durations.get("role_arn"), is_(equal_to(43200)))
+    finally:
+        chdir(cwd)
+        rmtree(directory)
+
+
+def test_cached_session_durations_unwritable():
+    directory = mkdtemp()
+    try:
+        # a file where the cache's directory should be
+        path = join(directory, "file")
+        open(path, "w").close()
+        cached_session_durations = CachedSessionDurations(path=join(path, "durations.json"))
+        cached_session_durations.set("role_arn", 43200)
+        assert_that(cached_session_durations.get("role_arn"), is_(none()))
+    finally:
+        rmtree(directory)
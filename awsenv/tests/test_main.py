@@ -1,11 +1,19 @@
 """
 Tests for command line input and output.
 """
+from time import time
+
 from hamcrest import assert_that, equal_to, is_, none
+from mock import patch
+
+from awsenv.cache import CachedSession, DEFAULT_SESSION_DURATION, MAX_SESSION_DURATION
+from awsenv.main import get_profile, get_profile_name, parse_args, to_environment
+from awsenv.profile import AWSProfile
+from awsenv.tests import custom_config, custom_session_durations, envvars
 
-from awsenv.cache import DEFAULT_SESSION_DURATION
-from awsenv.main import get_profile_name, parse_args, to_environment
-from awsenv.tests import envvars
+
+PROFILE = "custom"
+ROLE_ARN = "role_arn"
 
 
 def test_get_profile_name_default():
@@ -45,8 +53,89 @@ def test_parse_args_custom_session_duration():
     assert_that(args.session_duration, is_(100))
 
 
+def test_parse_args_max_session_duration():
+    args = parse_args(["--max-session-duration"])
+    assert_that(args.profile, is_(none()))
+    assert_that(args.max_session_duration, is_(True))
+
+
 def test_to_environment():
     assert_that(
         to_environment(dict(foo="bar", bar=None)),
         is_(equal_to("unset bar;\nexport foo=bar")),
     )
+
+
+def test_get_profile_max_session_duration_expired():
+    """
+    A session is judged against the duration it was issued with, not the role's maximum.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            cached_session_durations.set(ROLE_ARN, MAX_SESSION_DURATION)
+            with envvars(
+                AWS_PROFILE=PROFILE,
+                AWS_SESSION_DURATION=str(DEFAULT_SESSION_DURATION),
+                AWS_SESSION_NAME=CachedSession.make_name(),
+                AWS_SESSION_TOKEN="token",
+            ):
+                later = time() + 2 * DEFAULT_SESSION_DURATION
+                with patch("awsenv.cache.time", return_value=later):
+                    with patch.object(AWSProfile, "assume_role") as assume_role:
+                        assume_role.return_value = None, None
+                        get_profile(max_session_duration=True)
+
+                assert_that(assume_role.call_count, is_(equal_to(1)))
+
+
+def test_get_profile_max_session_duration_valid():
+    """
+    A session issued with a longer duration is reused while it is valid.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations():
+            with envvars(
+                AWS_PROFILE=PROFILE,
+                AWS_SESSION_DURATION=str(MAX_SESSION_DURATION),
+                AWS_SESSION_NAME=CachedSession.make_name(),
+                AWS_SESSION_TOKEN="token",
+            ):
+                later = time() + 2 * DEFAULT_SESSION_DURATION
+                with patch("awsenv.cache.time", return_value=later):
+                    with patch.object(AWSProfile, "assume_role") as assume_role:
+                        aws_profile = get_profile(max_session_duration=True)
+
+                assert_that(assume_role.call_count, is_(equal_to(0)))
+                assert_that(
+                    aws_profile.to_envvars().get("AWS_SESSION_DURATION"),
+                    is_(equal_to(str(MAX_SESSION_DURATION))),
+                )
+
+
+def test_get_profile_max_session_duration_refresh():
+    """
+    Refreshing negotiates a role's maximum session duration again.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            cached_session_durations.set(ROLE_ARN, 7200)
+            with patch("awsenv.profile.Session.create_client") as create_client:
+                sts_client = create_client.return_value
+                sts_client.assume_role.return_value = dict(
+                    Credentials=dict(
+                        AccessKeyId="access_key",
+                        SecretAccessKey="secret_key",
+                        SessionToken="token",
+                    ),
+                )
+                aws_profile = get_profile(PROFILE, max_session_duration=True, refresh=True)
+
+            assert_that(
+                sts_client.assume_role.call_args[1]["DurationSeconds"],
+                is_(equal_to(MAX_SESSION_DURATION)),
+            )
+            assert_that(aws_profile.session_duration, is_(equal_to(MAX_SESSION_DURATION)))
+            assert_that(
+                cached_session_durations.get(ROLE_ARN),
+                is_(equal_to(MAX_SESSION_DURATION)),
+            )
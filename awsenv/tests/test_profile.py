@@ -1,16 +1,36 @@
 """
 Test for profile processing.
 """
-from contextlib import contextmanager
-from mock import patch
+from botocore.exceptions import ClientError, ParamValidationError
+try:
+    from botocore import configloader
+except ImportError:
+    # botocore < 1.4 loads configuration from botocore.config
+    from botocore import config as configloader
+from mock import MagicMock, patch
 from os import environ
-from tempfile import NamedTemporaryFile
-from textwrap import dedent
+from threading import Event
 
-from hamcrest import assert_that, equal_to, is_, none
+from hamcrest import (
+    assert_that,
+    calling,
+    contains_inanyorder,
+    equal_to,
+    has_key,
+    is_,
+    is_not,
+    none,
+    raises,
+    same_instance,
+)
 
-from awsenv.cache import CachedSession, DEFAULT_SESSION_DURATION
-from awsenv.profile import AWSProfile
+from awsenv.cache import (
+    CachedSession,
+    DEFAULT_SESSION_DURATION,
+    MAX_SESSION_DURATION,
+)
+from awsenv.profile import AWSProfile, fan_out_clients, SessionFactory
+from awsenv.tests import custom_config, custom_session_durations
 
 
 CACHED_SESSION = CachedSession(
@@ -22,29 +42,30 @@ PROFILE = "custom"
 ROLE_ARN = "role_arn"
 
 
-@contextmanager
-def custom_config(profile, role_arn=None):
+def make_sts_client(max_session_duration):
     """
-    Inject a temporary AWS configuration, overriding ~/.aws/config.
+    Create a mock STS client that rejects durations beyond a maximum.
     """
-    with NamedTemporaryFile() as file_:
-        file_.write(dedent("""\
-            [default]
-            region = us-west-2
+    def assume_role(RoleArn, RoleSessionName, DurationSeconds):
+        if DurationSeconds > max_session_duration:
+            raise ClientError(
+                dict(Error=dict(
+                    Code="ValidationError",
+                    Message="The requested DurationSeconds exceeds the MaxSessionDuration",
+                )),
+                "AssumeRole",
+            )
+        return dict(
+            Credentials=dict(
+                AccessKeyId="access_key",
+                SecretAccessKey="secret_key",
+                SessionToken="token",
+            ),
+        )
 
-            [profile {}]
-            {}
-            source_profile = default
-        """.format(
-            profile,
-            "role_arn = {}".format(role_arn) if role_arn else "",
-        )))
-        file_.flush()
-        environ["AWS_CONFIG_FILE"] = file_.name
-        try:
-            yield
-        finally:
-            del environ["AWS_CONFIG_FILE"]
+    sts_client = MagicMock()
+    sts_client.assume_role.side_effect = assume_role
+    return sts_client
 
 
 def test_profile_no_role_arn():
@@ -150,3 +171,424 @@ def test_profile_region_from_envvar():
             cached_session=None,
         )
         assert_that(aws_profile.region_name, is_(equal_to(region)))
+
+
+def test_profile_session_factory_shares_config():
+    """
+    Profiles created from the same session factory share configuration and loaders.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with patch.object(
+            configloader,
+            "load_config",
+            wraps=configloader.load_config,
+        ) as load_config:
+            session_factory = SessionFactory()
+            aws_profiles = [
+                AWSProfile(
+                    profile=profile,
+                    session_duration=DEFAULT_SESSION_DURATION,
+                    cached_session=None,
+                    session_factory=session_factory,
+                )
+                for profile in [PROFILE, "default", PROFILE]
+            ]
+            for aws_profile in aws_profiles:
+                aws_profile.merged_config
+
+        # the configuration is parsed once for all profiles
+        assert_that(load_config.call_count, is_(equal_to(1)))
+
+        first, second = [aws_profile.session for aws_profile in aws_profiles[:2]]
+
+        assert_that(
+            first.full_config["profiles"]["default"],
+            is_(same_instance(second.full_config["profiles"]["default"])),
+        )
+        assert_that(
+            first.get_component("data_loader"),
+            is_(same_instance(second.get_component("data_loader"))),
+        )
+        assert_that(aws_profiles[0].role_arn, is_(equal_to(ROLE_ARN)))
+        assert_that(aws_profiles[1].role_arn, is_(none()))
+
+
+def test_profile_session_factory_generated_profiles():
+    """
+    Generated profile configuration is not shared between profiles from the same factory.
+    """
+    with custom_config(profile=PROFILE):
+        session_factory = SessionFactory()
+        aws_profiles = [
+            AWSProfile(
+                profile="generated",
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                account_id=account_id,
+                session_factory=session_factory,
+            )
+            for account_id in ["111", "222"]
+        ]
+
+        assert_that(
+            [aws_profile.role_arn for aws_profile in aws_profiles],
+            is_(equal_to([
+                "arn:aws:iam::111:role/generated",
+                "arn:aws:iam::222:role/generated",
+            ])),
+        )
+        assert_that(
+            session_factory.create_session("generated").full_config["profiles"],
+            is_not(has_key("generated")),
+        )
+
+
+def test_profile_session_factory_shares_sts_client():
+    """
+    Profiles with the same source profile reuse one STS client.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        session_factory = SessionFactory()
+        sts_client = MagicMock()
+        sts_client.assume_role.return_value = dict(
+            Credentials=dict(
+                AccessKeyId="access_key",
+                SecretAccessKey="secret_key",
+                SessionToken="token",
+            ),
+        )
+        for _ in range(2):
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                session_factory=session_factory,
+            )
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+        assert_that(len(session_factory.clients), is_(equal_to(1)))
+        assert_that(sts_client.assume_role.call_count, is_(equal_to(2)))
+
+
+def test_profile_create_regional_clients():
+    """
+    Regional clients share the profile's credentials but not its region.
+    """
+    with custom_config(profile=PROFILE):
+        aws_profile = AWSProfile(
+            profile=PROFILE,
+            session_duration=DEFAULT_SESSION_DURATION,
+            cached_session=CACHED_SESSION,
+        )
+        region_names = ["us-east-1", "us-west-2"]
+        with patch.object(aws_profile.session, "create_client") as create_client:
+            create_client.side_effect = lambda **kwargs: kwargs
+            clients = aws_profile.create_regional_clients("ec2", region_names)
+
+        assert_that(create_client.call_count, is_(equal_to(2)))
+        assert_that(clients.keys(), contains_inanyorder(*region_names))
+        for region_name, client in clients.items():
+            assert_that(client["region_name"], is_(equal_to(region_name)))
+            assert_that(client["aws_session_token"], is_(equal_to(CACHED_SESSION.token)))
+
+
+def test_profile_max_session_duration_negotiated():
+    """
+    A profile negotiates its role's maximum session duration and caches it.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+            )
+            assert_that(aws_profile.known_session_duration(), is_(none()))
+
+            sts_client = make_sts_client(14400)
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+            assert_that(sts_client.assume_role.call_count, is_(equal_to(5)))
+            assert_that(aws_profile.session_duration, is_(equal_to(14400)))
+            assert_that(
+                aws_profile.to_envvars().get("AWS_SESSION_DURATION"),
+                is_(equal_to("14400")),
+            )
+            assert_that(cached_session_durations.get(ROLE_ARN), is_(equal_to(14400)))
+            assert_that(aws_profile.known_session_duration(), is_(equal_to(14400)))
+
+
+def test_profile_max_session_duration_cached():
+    """
+    A profile with a cached maximum session duration requests it directly.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            cached_session_durations.set(ROLE_ARN, 7200)
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+            )
+
+            sts_client = make_sts_client(MAX_SESSION_DURATION)
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+            assert_that(sts_client.assume_role.call_count, is_(equal_to(1)))
+            assert_that(aws_profile.session_duration, is_(equal_to(7200)))
+
+
+def test_profile_max_session_duration_configured():
+    """
+    A profile's `duration_seconds` configuration takes precedence over the cache.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN, duration_seconds=28800):
+        with custom_session_durations() as cached_session_durations:
+            cached_session_durations.set(ROLE_ARN, 7200)
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+            )
+            assert_that(aws_profile.known_session_duration(), is_(equal_to(28800)))
+
+            sts_client = make_sts_client(MAX_SESSION_DURATION)
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+            assert_that(sts_client.assume_role.call_count, is_(equal_to(1)))
+            assert_that(aws_profile.session_duration, is_(equal_to(28800)))
+            # configured durations are not cached
+            assert_that(cached_session_durations.get(ROLE_ARN), is_(equal_to(7200)))
+
+
+def test_profile_max_session_duration_whole_hours():
+    """
+    A profile negotiates any whole-hour maximum session duration.
+    """
+    for max_session_duration in range(3600, MAX_SESSION_DURATION + 1, 3600):
+        with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+            with custom_session_durations():
+                aws_profile = AWSProfile(
+                    profile=PROFILE,
+                    session_duration=DEFAULT_SESSION_DURATION,
+                    cached_session=None,
+                    max_session_duration=True,
+                )
+
+                sts_client = make_sts_client(max_session_duration)
+                with patch.object(aws_profile.session, "create_client") as create_client:
+                    create_client.return_value = sts_client
+                    aws_profile.update_credentials()
+
+                assert_that(aws_profile.session_duration, is_(equal_to(max_session_duration)))
+
+
+def test_profile_max_session_duration_refresh():
+    """
+    Refreshing ignores a cached maximum session duration and negotiates it again.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            cached_session_durations.set(ROLE_ARN, 7200)
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+                refresh=True,
+            )
+
+            sts_client = make_sts_client(MAX_SESSION_DURATION)
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+            assert_that(aws_profile.session_duration, is_(equal_to(MAX_SESSION_DURATION)))
+            assert_that(
+                cached_session_durations.get(ROLE_ARN),
+                is_(equal_to(MAX_SESSION_DURATION)),
+            )
+
+
+def test_profile_max_session_duration_invalid_configuration():
+    """
+    An invalid `duration_seconds` configuration is ignored.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN, duration_seconds="12h"):
+        with custom_session_durations():
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+            )
+            assert_that(aws_profile.configured_session_duration, is_(none()))
+
+            sts_client = make_sts_client(7200)
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                aws_profile.update_credentials()
+
+            assert_that(aws_profile.session_duration, is_(equal_to(7200)))
+
+
+def test_profile_max_session_duration_other_error():
+    """
+    Errors unrelated to the session duration are raised without retrying.
+    """
+    with custom_config(profile=PROFILE, role_arn=ROLE_ARN):
+        with custom_session_durations() as cached_session_durations:
+            aws_profile = AWSProfile(
+                profile=PROFILE,
+                session_duration=DEFAULT_SESSION_DURATION,
+                cached_session=None,
+                max_session_duration=True,
+            )
+
+            sts_client = MagicMock()
+            sts_client.assume_role.side_effect = ClientError(
+                dict(Error=dict(Code="ValidationError", Message="Invalid RoleArn")),
+                "AssumeRole",
+            )
+            with patch.object(aws_profile.session, "create_client") as create_client:
+                create_client.return_value = sts_client
+                assert_that(
+                    calling(aws_profile.update_credentials),
+                    raises(ClientError),
+                )
+
+            assert_that(sts_client.assume_role.call_count, is_(equal_to(1)))
+            assert_that(cached_session_durations.get(ROLE_ARN), is_(none()))
+
+
+def make_fan_out_clients(region_names):
+    """
+    Create mock clients whose `describe_instances` returns their region name.
+    """
+    clients = {}
+    for region_name in region_names:
+        clients[region_name] = MagicMock()
+        clients[region_name].describe_instances.return_value = region_name
+    return clients
+
+
+def test_profile_fan_out():
+    """
+    Fan out creates regional clients and yields each region's result.
+    """
+    with custom_config(profile=PROFILE):
+        aws_profile = AWSProfile(
+            profile=PROFILE,
+            session_duration=DEFAULT_SESSION_DURATION,
+            cached_session=None,
+        )
+        clients = make_fan_out_clients(["us-east-1", "us-west-2", "eu-west-1"])
+        with patch.object(aws_profile.session, "create_client") as create_client:
+            create_client.side_effect = lambda region_name, **kwargs: clients[region_name]
+            results = list(aws_profile.fan_out(
+                "ec2",
+                list(clients),
+                "describe_instances",
+                MaxResults=5,
+            ))
+
+        assert_that(
+            results,
+            contains_inanyorder(*[
+                (region_name, region_name, None)
+                for region_name in clients
+            ]),
+        )
+        for client in clients.values():
+            client.describe_instances.assert_called_once_with(MaxResults=5)
+
+
+def test_fan_out_clients_concurrent():
+    """
+    Fan out runs calls concurrently.
+    """
+    region_names = ["us-east-1", "us-west-2"]
+    started = dict((region_name, Event()) for region_name in region_names)
+
+    def make_client(region_name, other_region_name):
+        # each call only succeeds if the other call is running at the same time
+        def describe_instances():
+            started[region_name].set()
+            return started[other_region_name].wait(5)
+
+        client = MagicMock()
+        client.describe_instances.side_effect = describe_instances
+        return client
+
+    clients = {
+        region_names[0]: make_client(*region_names),
+        region_names[1]: make_client(*reversed(region_names)),
+    }
+    results = list(fan_out_clients(clients, "describe_instances"))
+
+    assert_that(
+        results,
+        contains_inanyorder(*[(region_name, True, None) for region_name in region_names]),
+    )
+
+
+def test_fan_out_clients_error():
+    """
+    Fan out yields a failing region's error without losing other results.
+    """
+    error = ClientError(
+        dict(Error=dict(Code="AuthFailure", Message="AuthFailure")),
+        "DescribeInstances",
+    )
+    clients = make_fan_out_clients(["us-east-1", "us-west-2", "ap-east-1"])
+    clients["ap-east-1"].describe_instances.side_effect = error
+
+    results = list(fan_out_clients(clients, "describe_instances"))
+
+    assert_that(
+        results,
+        contains_inanyorder(
+            ("us-east-1", "us-east-1", None),
+            ("us-west-2", "us-west-2", None),
+            ("ap-east-1", None, error),
+        ),
+    )
+
+
+def test_fan_out_clients_unknown_operation():
+    """
+    Fan out raises unknown operations instead of yielding them per region.
+    """
+    clients = dict(
+        (region_name, object())
+        for region_name in ["us-east-1", "us-west-2"]
+    )
+    assert_that(
+        calling(list).with_args(fan_out_clients(clients, "describe_instancez")),
+        raises(AttributeError),
+    )
+
+
+def test_fan_out_clients_invalid_parameters():
+    """
+    Fan out raises invalid parameters instead of yielding them per region.
+    """
+    clients = make_fan_out_clients(["us-east-1", "us-west-2"])
+    for client in clients.values():
+        client.describe_instances.side_effect = ParamValidationError(report="MaxResultz")
+
+    assert_that(
+        calling(list).with_args(fan_out_clients(clients, "describe_instances", MaxResultz=5)),
+        raises(ParamValidationError),
+    )